@@ -0,0 +1,59 @@
+# Compares the chunklist loader against the previous ElementTree based one
+import hashlib
+import timeit
+import xml.etree.ElementTree as ETree
+
+import dateutil.parser
+
+from gogapi.download import File, Chunk
+
+CHUNK_COUNT = 1000 # 10 GB installer
+CHUNK_SIZE = 10 * 1024 * 1024
+ROUNDS = 50
+
+
+def make_chunklist(chunk_count):
+    lines = [
+        '<file name="setup.bin" available="1" notavailablemsg="" '
+        'md5="{}" chunks="{}" timestamp="2017-06-01 13:12:23" '
+        'total_size="{}">'.format(
+            hashlib.md5(b"file").hexdigest(), chunk_count,
+            chunk_count * CHUNK_SIZE)]
+    for chunk_id in range(chunk_count):
+        lines.append(
+            '\t<chunk id="{}" from="{}" to="{}" method="md5">{}</chunk>'.format(
+                chunk_id, chunk_id * CHUNK_SIZE,
+                (chunk_id + 1) * CHUNK_SIZE - 1,
+                hashlib.md5(str(chunk_id).encode()).hexdigest()))
+    lines.append("</file>")
+    return "\n".join(lines).encode("utf-8")
+
+def load_old(xml_data):
+    tree = ETree.fromstring(xml_data.decode("utf-8"))
+    timestamp = dateutil.parser.parse(tree.attrib["timestamp"])
+    chunks = []
+    for chunk_elem in tree:
+        chunks.append(Chunk(
+            chunk_id=int(chunk_elem.attrib["id"]),
+            start=int(chunk_elem.attrib["from"]),
+            end=int(chunk_elem.attrib["to"]),
+            method=chunk_elem.attrib["method"],
+            digest=chunk_elem.text
+        ))
+    return timestamp, chunks
+
+def load_new(xml_data):
+    fileobj = File(None, {"id": 1, "size": 0, "downlink": None})
+    fileobj.load_chunklist_xml(xml_data)
+    return fileobj.timestamp, fileobj.chunks
+
+
+xml_data = make_chunklist(CHUNK_COUNT)
+assert load_old(xml_data)[0] == load_new(xml_data)[0]
+assert [c.digest for c in load_old(xml_data)[1]] == \
+    [c.digest for c in load_new(xml_data)[1]]
+
+for name, func in [("ElementTree", load_old), ("ChunkList", load_new)]:
+    seconds = timeit.timeit(lambda: func(xml_data), number=ROUNDS)
+    print("{:12} {:8.3f} ms per chunklist".format(
+        name, seconds / ROUNDS * 1000))
@@ -2,8 +2,10 @@ import gogapi.names as names
 
 from gogapi.token import get_auth_url, Token
 from gogapi.api import GogApi
+from gogapi.asyncapi import AsyncGogApi
 from gogapi.base import (
     GogError,
     ApiError,
     MissingResourceError,
-    NotAuthorizedError)
+    NotAuthorizedError,
+    ChecksumError)
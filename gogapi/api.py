@@ -3,12 +3,18 @@ import re
 import logging
 import html.parser
 import zlib
+import socket
+import urllib.parse
 
 import requests
+import requests.adapters
+from urllib3.connection import HTTPConnection
 
 from gogapi import urls
-from gogapi.base import NotAuthorizedError, logger
+from gogapi.base import NotAuthorizedError, logger, run_parallel
 from gogapi.product import Product, Series
+from gogapi.contentsystem import SecureLinkCache
+from gogapi.cache import CachedResponse, ResponseCache
 from gogapi.search import SearchResult
 
 DEBUG_JSON = False
@@ -16,6 +22,13 @@ GOGDATA_RE = re.compile(r"gogData\.?(.*?) = (.+);")
 CLIENT_VERSION = "1.2.17.9" # Just for their statistics
 USER_AGENT = "GOGGalaxyClient/{} pygogapi/0.1".format(CLIENT_VERSION)
 REQUEST_RETRIES = 3
+POOL_MAXSIZE = 32
+KEEPALIVE_IDLE = 60
+# Hosts from urls.gog_servers that get the CDN session if it is separate
+CDN_HOSTS = ["cdn"]
+BUILDS_WORKERS = 32
+SYSTEMS = ["windows", "mac", "linux"]
+STREAM_BLOCK_SIZE = 64 * 1024
 
 
 PRODUCT_EXPANDABLE = [
@@ -52,16 +65,101 @@ class ScriptParser(html.parser.HTMLParser):
 
 
 
+class PoolAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter that passes socket options to its connection pools"""
+
+    def __init__(self, socket_options=None, **kwargs):
+        self.socket_options = socket_options
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.socket_options is not None:
+            kwargs["socket_options"] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+def keepalive_options(idle):
+    """Socket options enabling TCP keep-alive probes after idle seconds"""
+    options = HTTPConnection.default_socket_options + [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle))
+    elif hasattr(socket, "TCP_KEEPALIVE"): # macOS
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle))
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, idle))
+    return options
+
+
 class GogApi:
-    def __init__(self, token=None):
+    def __init__(self, token=None, manifest_cache=None,
+                 pool_maxsize=POOL_MAXSIZE, host_pool_sizes=None,
+                 pool_block=False, keepalive_idle=KEEPALIVE_IDLE,
+                 separate_cdn_pool=False):
+        """
+        manifest_cache: Optional gogapi.cache.ManifestCache for content
+            system V2 meta files
+        pool_maxsize: Connections kept alive per host
+        host_pool_sizes: Per host overrides of pool_maxsize by
+            urls.gog_servers key, e.g. {"cdn": 64}
+        pool_block: Wait for a free connection instead of opening extra
+            connections that are discarded afterwards
+        keepalive_idle: Seconds before TCP keep-alive probes are sent on
+            idle connections, None to disable them
+        separate_cdn_pool: Send requests to the CDN and any host not in
+            urls.gog_servers through their own session, so download
+            traffic can't evict the API connections
+        """
         self.token = token
+        self.manifest_cache = manifest_cache
         self.locale = (None, None, None) # TODO: replace tuple
-        self.session = requests.Session()
-        self.session.headers["User-Agent"] = USER_AGENT
         self.force_authorize = False
+        self.secure_links = SecureLinkCache(self)
+        self.response_cache = ResponseCache()
+
+        self.pool_maxsize = pool_maxsize
+        self.host_pool_sizes = host_pool_sizes or {}
+        self.pool_block = pool_block
+        if keepalive_idle is None:
+            self.socket_options = None
+        else:
+            self.socket_options = keepalive_options(keepalive_idle)
+
+        self.session = self.create_session()
+        if separate_cdn_pool:
+            self.cdn_session = self.create_session()
+            self.api_hosts = set(
+                urllib.parse.urlsplit(host_url).netloc
+                for host_id, host_url in urls.gog_servers.items()
+                if host_id not in CDN_HOSTS)
+        else:
+            self.cdn_session = None
 
     # Helpers
 
+    def create_session(self):
+        session = requests.Session()
+        session.headers["User-Agent"] = USER_AGENT
+        session.mount("https://", self.create_adapter(self.pool_maxsize))
+        session.mount("http://", self.create_adapter(self.pool_maxsize))
+        for host_id, host_url in urls.gog_servers.items():
+            size = self.host_pool_sizes.get(host_id, self.pool_maxsize)
+            session.mount(host_url, self.create_adapter(size))
+        return session
+
+    def create_adapter(self, pool_maxsize):
+        return PoolAdapter(
+            socket_options=self.socket_options,
+            pool_connections=len(urls.gog_servers),
+            pool_maxsize=pool_maxsize,
+            pool_block=self.pool_block)
+
+    def session_for(self, url):
+        if self.cdn_session is not None and \
+                urllib.parse.urlsplit(url).netloc not in self.api_hosts:
+            return self.cdn_session
+        return self.session
+
     def request(self, method, url, authorized=True, allow_redirects=False,
                 **kwargs):
         """
@@ -69,21 +167,22 @@ class GogApi:
         retries and logging
         """
 
+        # Per request headers, the sessions are shared between threads
+        headers = dict(kwargs.pop("headers", None) or {})
         if authorized or self.force_authorize:
             if self.token is None:
                 raise NotAuthorizedError()
             if self.token.expired():
                 self.token.refresh()
-            self.session.headers["Authorization"] = \
-                "Bearer " + self.token.access_token
-        else:
-            self.session.headers.pop("Authorization", None)
+            headers["Authorization"] = "Bearer " + self.token.access_token
 
         # Retries
+        session = self.session_for(url)
         retries = REQUEST_RETRIES
         while retries > 0:
-            resp = self.session.request(
-                method, url, allow_redirects=allow_redirects, **kwargs)
+            resp = session.request(
+                method, url, allow_redirects=allow_redirects,
+                headers=headers, **kwargs)
             if resp.status_code < 400:
                 return resp
             elif 400 <= resp.status_code < 500:
@@ -130,6 +229,26 @@ class GogApi:
         """
         return self.request_json("GET", *args, **kwargs)
 
+    def get_json_cached(self, url, **kwargs):
+        """
+        Conditional GET of a JSON resource using ETag and Last-Modified.
+        Returns a CachedResponse, the previous one if the server replied
+        with 304 Not Modified.
+        """
+        entry = self.response_cache.get(url)
+        headers = dict(kwargs.pop("headers", None) or {})
+        if entry is not None:
+            headers.update(entry.headers)
+        resp = self.get(url, headers=headers, **kwargs)
+        if resp.status_code == 304 and entry is not None:
+            return entry
+        entry = CachedResponse(
+            resp.json(), resp.headers.get("ETag"),
+            resp.headers.get("Last-Modified"))
+        if entry.etag or entry.last_modified:
+            self.response_cache.put(url, entry)
+        return entry
+
     def get_gogdata(self, url, *args, **kwargs):
         """
         Downloads a page and returns the embedded JavaScript gogData
@@ -165,6 +284,9 @@ class GogApi:
             return AttributeError("Invalid locale code {}".format(locale))
 
         self.locale = (country, currency, locale)
+        self.update_locale_cookie()
+
+    def update_locale_cookie(self):
         self.session.cookies["gog_lc"] = "_".join(self.locale)
 
 
@@ -395,7 +517,7 @@ class GogApi:
         if user_id is None:
             user_id = self.token.user_id
         reqdata = {"version": CLIENT_VERSION}
-        self.post(urls.galaxy("status", user_id), data=reqdata)
+        return self.post(urls.galaxy("status", user_id), data=reqdata)
 
     def galaxy_statuses(self, user_ids):
         user_ids_str = ",".join(user_ids)
@@ -461,14 +583,51 @@ class GogApi:
             params={"path": path, "generation": generation})
 
     def galaxy_builds(self, game_id, system):
-        return self.get_json(
+        return self.galaxy_builds_cached(game_id, system).data
+
+    def galaxy_builds_cached(self, game_id, system):
+        return self.get_json_cached(
             urls.galaxy("cs.builds", game_id, system), authorized=False)
 
-    def galaxy_cs_meta(self, meta_id):
-        return self.get_json(
+    def galaxy_cs_meta_bytes(self, meta_id, url=None):
+        """
+        Returns the compressed content system V2 meta file, consulting
+        the manifest cache first
+        """
+        if self.manifest_cache is not None:
+            data = self.manifest_cache.get(meta_id)
+            if data is not None:
+                return data
+        if url is None:
+            url = urls.galaxy("cs.meta", meta_id[0:2], meta_id[2:4], meta_id)
+        data = self.get(url, authorized=False).content
+        if self.manifest_cache is not None:
+            self.manifest_cache.put(meta_id, data)
+        return data
+
+    def galaxy_cs_meta(self, meta_id, url=None):
+        json_text = zlib.decompress(
+            self.galaxy_cs_meta_bytes(meta_id, url), 15).decode("utf-8")
+        if DEBUG_JSON:
+            print(json_text)
+        return json.loads(json_text)
+
+    def galaxy_cs_meta_stream(self, meta_id):
+        """
+        Returns an iterator over the still compressed blocks of a content
+        system V2 meta file
+        """
+        if self.manifest_cache is not None:
+            # The compressed file is the smallest form worth caching
+            data = self.galaxy_cs_meta_bytes(meta_id)
+            return (
+                data[pos:pos + STREAM_BLOCK_SIZE]
+                for pos in range(0, len(data), STREAM_BLOCK_SIZE))
+        resp = self.get(
             urls.galaxy("cs.meta", meta_id[0:2], meta_id[2:4], meta_id),
-            compressed=True,
+            stream=True,
             authorized=False)
+        return resp.iter_content(STREAM_BLOCK_SIZE)
 
     def galaxy_client_config():
         return self.get_json(urls.galaxy("client-config"), authorized=False)
@@ -476,6 +635,25 @@ class GogApi:
     def product(self, product_id, slug=None):
         return Product(self, product_id, slug)
 
+    def get_builds_bulk(self, product_ids, systems=SYSTEMS,
+                        max_workers=BUILDS_WORKERS):
+        """
+        Fetches the builds of many products for all systems concurrently.
+        Returns a dict of (product_id, system) to a list of Build, or None
+        if the listing couldn't be fetched.
+        """
+        def get_builds(key):
+            try:
+                return self.product(key[0]).get_builds(key[1])
+            except (requests.RequestException, ValueError) as e:
+                logger.warning("Failed to get builds for %s: %s", key, e)
+                return None
+
+        keys = [
+            (int(product_id), system)
+            for product_id in product_ids for system in systems]
+        return dict(run_parallel(get_builds, keys, max_workers))
+
     def search(self, **query):
         search_data = self.web_search(**query)
         return SearchResult(self, query, search_data)
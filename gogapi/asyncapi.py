@@ -0,0 +1,282 @@
+import asyncio
+import json
+import time
+import zlib
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from gogapi import urls
+from gogapi.api import (
+    GogApi, GOGDATA_RE, USER_AGENT, REQUEST_RETRIES, STREAM_BLOCK_SIZE,
+    SYSTEMS, DEBUG_JSON)
+from gogapi.base import NotAuthorizedError, logger
+from gogapi.cache import CachedResponse, ResponseCache
+from gogapi.contentsystem import (
+    Build, SecureLinkV2, SECURE_LINK_REFRESH_MARGIN)
+from gogapi.search import SearchResult
+
+MAX_CONNECTIONS = 100
+
+
+class AsyncGogApi(GogApi):
+    """
+    asyncio version of GogApi built on aiohttp. All request and endpoint
+    methods are coroutines and share the URL tables with GogApi. Models
+    can be created with the get_* helpers, their update_* methods are
+    only available with the blocking GogApi. Connections are pooled by
+    the aiohttp connector, limited to max_connections.
+    """
+
+    def __init__(self, token=None, manifest_cache=None,
+                 max_connections=MAX_CONNECTIONS):
+        # GogApi.__init__ is not called, it sets up requests sessions
+        if aiohttp is None:
+            raise ImportError("AsyncGogApi requires aiohttp")
+        self.token = token
+        self.manifest_cache = manifest_cache
+        self.locale = (None, None, None)
+        self.max_connections = max_connections
+        self.session = None
+        self.cdn_session = None
+        self.force_authorize = False
+        self.secure_links = AsyncSecureLinkCache(self)
+        self.response_cache = ResponseCache()
+
+    def get_session(self):
+        # aiohttp sessions have to be created inside the event loop
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                headers={"User-Agent": USER_AGENT})
+            if self.locale[0] is not None:
+                self.session.cookie_jar.update_cookies(
+                    {"gog_lc": "_".join(self.locale)})
+        return self.session
+
+    def session_for(self, url):
+        return self.get_session()
+
+    def create_session(self):
+        raise NotImplementedError("AsyncGogApi uses a single aiohttp session")
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # Helpers
+
+    async def request(self, method, url, authorized=True,
+                      allow_redirects=False, stream=False, **kwargs):
+        """
+        Wrapper around aiohttp requests that also handles authorization,
+        retries and logging. The body is read before returning unless
+        stream is set, then the caller has to release the response.
+        """
+
+        headers = dict(kwargs.pop("headers", None) or {})
+        if authorized or self.force_authorize:
+            if self.token is None:
+                raise NotAuthorizedError()
+            if self.token.expired():
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self.token.refresh)
+            headers["Authorization"] = "Bearer " + self.token.access_token
+
+        session = self.session_for(url)
+        retries = REQUEST_RETRIES
+        while retries > 0:
+            resp = await session.request(
+                method, url, allow_redirects=allow_redirects,
+                headers=headers, **kwargs)
+            if resp.status < 400:
+                if not stream:
+                    await resp.read()
+                return resp
+            await resp.read()
+            if resp.status < 500:
+                break
+            retries -= 1
+
+        resp.raise_for_status()
+
+    async def request_json(self, *args, compressed=False, **kwargs):
+        resp = await self.request(*args, **kwargs)
+        body = await resp.read()
+        if compressed:
+            body = zlib.decompress(body, 15)
+        json_text = body.decode("utf-8")
+        if DEBUG_JSON:
+            print(json_text)
+        return json.loads(json_text)
+
+    async def get_json_cached(self, url, **kwargs):
+        entry = self.response_cache.get(url)
+        headers = dict(kwargs.pop("headers", None) or {})
+        if entry is not None:
+            headers.update(entry.headers)
+        resp = await self.get(url, headers=headers, **kwargs)
+        if resp.status == 304 and entry is not None:
+            return entry
+        entry = CachedResponse(
+            json.loads(await resp.read()), resp.headers.get("ETag"),
+            resp.headers.get("Last-Modified"))
+        if entry.etag or entry.last_modified:
+            self.response_cache.put(url, entry)
+        return entry
+
+    async def get_gogdata(self, url, *args, **kwargs):
+        resp = await self.get(url, *args, **kwargs)
+        text = await resp.text()
+        gogdata = {}
+        for match in GOGDATA_RE.finditer(text):
+            subkey = match.group(1)
+            value_parsed = json.loads(match.group(2))
+            if subkey:
+                gogdata[subkey] = value_parsed
+            else:
+                gogdata.update(value_parsed)
+        return gogdata
+
+    def update_locale_cookie(self):
+        if self.session is not None:
+            self.session.cookie_jar.update_cookies(
+                {"gog_lc": "_".join(self.locale)})
+
+    # Galaxy APIs
+
+    async def galaxy_cs_meta_bytes(self, meta_id, url=None):
+        if self.manifest_cache is not None:
+            data = self.manifest_cache.get(meta_id)
+            if data is not None:
+                return data
+        if url is None:
+            url = urls.galaxy("cs.meta", meta_id[0:2], meta_id[2:4], meta_id)
+        resp = await self.get(url, authorized=False)
+        data = await resp.read()
+        if self.manifest_cache is not None:
+            self.manifest_cache.put(meta_id, data)
+        return data
+
+    async def galaxy_builds(self, game_id, system):
+        resp = await self.galaxy_builds_cached(game_id, system)
+        return resp.data
+
+    async def galaxy_cs_meta(self, meta_id, url=None):
+        data = await self.galaxy_cs_meta_bytes(meta_id, url)
+        return json.loads(zlib.decompress(data, 15).decode("utf-8"))
+
+    async def galaxy_cs_meta_stream(self, meta_id):
+        """Async iterator over the compressed blocks of a V2 meta file"""
+        if self.manifest_cache is not None:
+            data = await self.galaxy_cs_meta_bytes(meta_id)
+            for pos in range(0, len(data), STREAM_BLOCK_SIZE):
+                yield data[pos:pos + STREAM_BLOCK_SIZE]
+            return
+        resp = await self.get(
+            urls.galaxy("cs.meta", meta_id[0:2], meta_id[2:4], meta_id),
+            stream=True,
+            authorized=False)
+        try:
+            async for block in resp.content.iter_chunked(STREAM_BLOCK_SIZE):
+                yield block
+        finally:
+            resp.release()
+
+    # Models
+
+    async def get_product(self, product_id, expand=False):
+        data = await self.galaxy_product(product_id, expand=expand)
+        product = self.product(product_id)
+        product.load_galaxy(data)
+        return product
+
+    async def get_builds(self, product_id, system):
+        if system == "mac":
+            system = "osx"
+        resp = await self.galaxy_builds_cached(product_id, system)
+        if "builds" not in resp.parsed:
+            builds = {
+                build.id: build for build in (
+                    Build(self, build_data)
+                    for build_data in resp.data["items"])}
+            resp.parsed["builds"] = list(builds.values())
+        return list(resp.parsed["builds"])
+
+    async def get_builds_bulk(self, product_ids, systems=SYSTEMS):
+        """
+        Fetches the builds of many products for all systems concurrently,
+        see GogApi.get_builds_bulk. Concurrency is bounded by
+        max_connections.
+        """
+        async def get_builds(key):
+            try:
+                return key, await self.get_builds(*key)
+            except (aiohttp.ClientError, asyncio.TimeoutError,
+                    ValueError) as e:
+                logger.warning("Failed to get builds for %s: %s", key, e)
+                return key, None
+
+        keys = [
+            (int(product_id), system)
+            for product_id in product_ids for system in systems]
+        return dict(await asyncio.gather(*map(get_builds, keys)))
+
+    async def search(self, **query):
+        search_data = await self.web_search(**query)
+        return SearchResult(self, query, search_data)
+
+
+class AsyncSecureLinkCache:
+    """
+    asyncio version of gogapi.contentsystem.SecureLinkCache, get and
+    refresh are coroutines. Links are refreshed once they are within
+    refresh_margin seconds of expiring, concurrent callers for the same
+    key share a single request.
+    """
+
+    def __init__(self, api, refresh_margin=SECURE_LINK_REFRESH_MARGIN):
+        self.api = api
+        self.refresh_margin = refresh_margin
+        self.links = {}
+        self.key_locks = {}
+
+    async def get(self, product_id, path="/", generation=2):
+        key = (int(product_id), path, generation)
+        link = self.links.get(key)
+        if link is not None and \
+                link.expires - time.time() >= self.refresh_margin:
+            return link
+        return await self.refresh(*key, stale=link)
+
+    async def refresh(self, product_id, path="/", generation=2, stale=None):
+        """See SecureLinkCache.refresh"""
+        key = (int(product_id), path, generation)
+        if stale is None:
+            stale = self.links.get(key)
+        key_lock = self.key_locks.setdefault(key, asyncio.Lock())
+        async with key_lock:
+            link = self.links.get(key)
+            if link is not None and link is not stale and \
+                    link.expires > time.time():
+                return link
+            if generation != 2:
+                raise NotImplementedError("V1 not implemented")
+            link_data = await self.api.galaxy_secure_link(
+                product_id, path, generation)
+            link = SecureLinkV2(self.api, link_data)
+            self.links[key] = link
+            return link
+
+    def handle(self, product_id, path="/", generation=2):
+        raise NotImplementedError(
+            "Self refreshing link handles require the blocking GogApi")
@@ -1,4 +1,6 @@
 import logging
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
 logging.basicConfig()
@@ -21,6 +23,9 @@ class MissingResourceError(GogError):
 class NotAuthorizedError(GogError):
     pass
 
+class ChecksumError(GogError):
+    pass
+
 
 class GogObject:
     def __init__(self, api):
@@ -37,3 +42,23 @@ class GogObject:
             attr_pairs.append("{}={!r}".format(name, value))
 
         return "{}({})".format(self.__class__.__name__, ", ".join(attr_pairs))
+
+
+def run_parallel(func, items, max_workers, executor_class=ThreadPoolExecutor):
+    """
+    Calls func for every item on a pool of max_workers workers, keeping
+    only a bounded number of items in flight. Yields (item, result) pairs
+    in completion order and reraises the first exception.
+    """
+    items = iter(items)
+    with executor_class(max_workers) as executor:
+        pending = {}
+        for item in itertools.islice(items, max_workers * 2):
+            pending[executor.submit(func, item)] = item
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                yield item, future.result()
+            for item in itertools.islice(items, len(done)):
+                pending[executor.submit(func, item)] = item
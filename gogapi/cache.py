@@ -0,0 +1,237 @@
+import os
+import time
+import zlib
+import hashlib
+import threading
+import collections
+
+from gogapi.base import logger
+
+# Fraction of max_size the store is shrunk to when it overflows
+EVICT_RATIO = 0.9
+RESPONSE_CACHE_ENTRIES = 10000
+# Temp files older than this are left over from a crashed writer. Younger
+# ones may belong to another process sharing the directory.
+STALE_TEMP_AGE = 3600
+INFLATE_BLOCK_SIZE = 64 * 1024
+
+
+class DiskCache:
+    """
+    Size bounded on-disk key-value store. Files are sharded like on the
+    CDN (ab/cd/abcd...) and entries are evicted least recently ("lru") or
+    least frequently ("lfu") used once the cache grows beyond max_size
+    bytes.
+    """
+
+    def __init__(self, directory, max_size, policy="lru"):
+        if policy not in ("lru", "lfu"):
+            raise ValueError("Unknown eviction policy {}".format(policy))
+        self.directory = directory
+        self.max_size = max_size
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # key -> size
+        self.hits = {}
+        self.size = 0
+        self.scan()
+
+    def scan(self):
+        """
+        Indexes existing entries, oldest modification time first, and
+        removes stale temp files
+        """
+        found = []
+        now = time.time()
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue # Removed by another process meanwhile
+                if filename.endswith(".tmp"):
+                    if now - stat.st_mtime > STALE_TEMP_AGE:
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                    continue
+                found.append((stat.st_mtime, filename, stat.st_size))
+        found.sort()
+        for mtime, key, size in found:
+            self.entries[key] = size
+            self.hits[key] = 0
+            self.size += size
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key[0:2], key[2:4], key)
+
+    def check(self, key, data):
+        """Integrity check run on every read and write"""
+        return True
+
+    def get(self, key):
+        """Returns the stored data or None if it is missing or corrupt"""
+        with self.lock:
+            if key not in self.entries:
+                return None
+        path = self.path_for(key)
+        try:
+            with open(path, "rb") as fobj:
+                data = fobj.read()
+        except FileNotFoundError:
+            self.discard(key)
+            return None
+        if not self.check(key, data):
+            logger.warning("Discarding corrupt cache entry %s", key)
+            self.discard(key)
+            return None
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits[key] += 1
+        try:
+            os.utime(path) # Keep the LRU order across restarts
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        """Stores data unless it is too large or fails check"""
+        if len(data) > self.max_size:
+            return
+        if not self.check(key, data):
+            logger.warning("Not caching corrupt entry %s", key)
+            return
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = "{}.{}.{}.tmp".format(
+            path, os.getpid(), threading.get_ident())
+        with open(temp_path, "wb") as fobj:
+            fobj.write(data)
+        os.replace(temp_path, path)
+
+        with self.lock:
+            self.size += len(data) - self.entries.get(key, 0)
+            self.entries[key] = len(data)
+            self.entries.move_to_end(key)
+            self.hits.setdefault(key, 0)
+            victims = self.select_victims()
+        for victim in victims:
+            try:
+                os.remove(self.path_for(victim))
+            except FileNotFoundError:
+                pass
+
+    def select_victims(self):
+        if self.size <= self.max_size:
+            return []
+        target = self.max_size * EVICT_RATIO
+        if self.policy == "lru":
+            candidates = iter(self.entries)
+        else:
+            candidates = sorted(self.entries, key=self.hits.__getitem__)
+        victims = []
+        for key in candidates:
+            if self.size <= target:
+                break
+            victims.append(key)
+            self.size -= self.entries[key]
+        for key in victims:
+            del self.entries[key]
+            del self.hits[key]
+        return victims
+
+    def discard(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return
+            self.size -= self.entries.pop(key)
+            del self.hits[key]
+        try:
+            os.remove(self.path_for(key))
+        except FileNotFoundError:
+            pass
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ChunkStore(DiskCache):
+    """
+    Content addressed store for compressed V2 chunks, keyed and verified
+    by their compressed md5
+    """
+
+    def check(self, key, data):
+        return hashlib.md5(data).hexdigest() == key
+
+
+class ManifestCache(DiskCache):
+    """
+    Store for the compressed V2 meta files (repositories and depot
+    manifests) keyed by meta id. The ids are content hashes, so entries
+    never go stale. Entries are checked to be complete zlib streams.
+    """
+
+    def check(self, key, data):
+        # Inflated in blocks, the output of large manifests is discarded
+        inflater = zlib.decompressobj(15)
+        try:
+            for pos in range(0, len(data), INFLATE_BLOCK_SIZE):
+                inflater.decompress(data[pos:pos + INFLATE_BLOCK_SIZE])
+        except zlib.error:
+            return False
+        return inflater.eof
+
+
+class CachedResponse:
+    """
+    JSON response with its validators. parsed holds objects derived from
+    the data, so they can be reused while the resource is unchanged.
+    """
+
+    def __init__(self, data, etag=None, last_modified=None):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.parsed = {}
+
+    @property
+    def headers(self):
+        """Headers for a conditional request revalidating this response"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """In-memory LRU of CachedResponse objects by URL"""
+
+    def __init__(self, max_entries=RESPONSE_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+            return entry
+
+    def put(self, url, entry):
+        with self.lock:
+            self.entries[url] = entry
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
@@ -1,11 +1,44 @@
 import re
+import os
+import zlib
+import hashlib
+import json
+import codecs
+import itertools
+import array
+import collections
+import collections.abc
+import bisect
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+
+import requests
 
 from gogapi.normalization import normalize_system, normalize_language
-from gogapi.base import GogObject
+from gogapi.base import (
+    GogObject, GogError, ChecksumError, logger, run_parallel)
+from gogapi import transfer
 
 # TODO: repr for everything
 
 META_ID_RE = re.compile(r"v2/meta/.{2}/.{2}/(\w+)")
+ITEMS_START_RE = re.compile(r'"items"\s*:\s*\[')
+DOWNLOAD_WORKERS = 32
+CHUNK_RETRIES = 3
+MANIFEST_WORKERS = 16
+HASH_BLOCK_SIZE = 1024 * 1024
+SECURE_LINK_EXPIRES_RE = re.compile(r"exp(?:ires)?=(\d+)")
+# Assumed lifetime of secure links without an expiry in their token
+SECURE_LINK_LIFETIME = 600
+SECURE_LINK_REFRESH_MARGIN = 120
+LINK_EXPIRED_STATUS = (401, 403, 410)
+# Holes between V1 slices up to this size are downloaded and discarded
+RANGE_MAX_GAP = 64 * 1024
+RANGE_MAX_SPAN = 64 * 1024 * 1024
+# Chunks written between two durable journal commits
+JOURNAL_COMMIT_INTERVAL = 256
 
 
 class Build(GogObject):
@@ -42,12 +75,41 @@ class Build(GogObject):
             repo_data = self.api.get_json(self.link, authorized=False)
             self.load_repo_v1(repo_data)
         elif self.generation == 2:
-            repo_data = self.api.get_json(
-                self.link, compressed=True, authorized=False)
+            if self.meta_id is not None:
+                repo_data = self.api.galaxy_cs_meta(self.meta_id, self.link)
+            else:
+                repo_data = self.api.get_json(
+                    self.link, compressed=True, authorized=False)
             self.load_repo_v2(repo_data)
         else:
             raise NotImplementedError()
 
+    def load_manifests(self, depot_filter=None):
+        """Loads the repository and the manifests of the selected depots"""
+        if "repo" not in self.loaded:
+            self.update_repo()
+        depots = [
+            depot for depot in self.repository.depots
+            if depot_filter is None or depot_filter(depot)]
+        load_depot_manifests(depots)
+        return depots
+
+    def delta(self, new_build, depot_filter=None):
+        """
+        Plans the update from this build to new_build. depot_filter
+        selects the depots to compare and defaults to all depots except
+        the offline depot.
+        """
+        if depot_filter is None:
+            depot_filter = lambda depot: not depot.is_offline
+        if self.generation != 2 or new_build.generation != 2:
+            raise NotImplementedError("Deltas require generation 2 builds")
+        old_depots = self.load_manifests(depot_filter)
+        new_depots = new_build.load_manifests(depot_filter)
+        return BuildDelta(
+            [depot.manifest for depot in old_depots],
+            [depot.manifest for depot in new_depots])
+
     @property
     def meta_id(self):
         match = META_ID_RE.search(self.link)
@@ -63,6 +125,22 @@ class Build(GogObject):
         ])
 
 
+def load_depot_manifests(depots, max_workers=MANIFEST_WORKERS):
+    """Concurrently loads the manifests of depots that aren't loaded yet"""
+    missing = [
+        depot for depot in depots if "manifest" not in depot.manifest.loaded]
+    for depot, _ in run_parallel(
+            lambda depot: depot.manifest.update_manifest(),
+            missing, max_workers):
+        pass
+
+def languages_match(depot_languages, languages):
+    if languages is None or "*" in depot_languages:
+        return True
+    languages = set(normalize_language(lang) for lang in languages)
+    return not languages.isdisjoint(depot_languages)
+
+
 ########################################
 # Generation 1
 ########################################
@@ -97,6 +175,23 @@ class RepositoryV1(GogObject):
         self.name = product_data["projectName"]
         assert repo_data["version"] == self.generation
 
+    def update_manifests(self, languages=None, product_ids=None,
+                         max_workers=MANIFEST_WORKERS):
+        """
+        Concurrently loads the manifests of all depots, optionally only
+        those matching any of the languages and product_ids. Returns the
+        selected depots.
+        """
+        if product_ids is not None:
+            product_ids = set(int(product_id) for product_id in product_ids)
+        depots = [
+            depot for depot in self.depots
+            if languages_match(depot.languages, languages) and (
+                product_ids is None or
+                not product_ids.isdisjoint(depot.game_ids))]
+        load_depot_manifests(depots, max_workers)
+        return depots
+
     def __repr__(self):
         return self.simple_repr(
             ["url", "name", "timestamp", "install_directory"])
@@ -210,6 +305,8 @@ class DepotManifestV1(GogObject):
                 self.dirs.append(DepotDirectoryV1(self.api, item))
             else:
                 self.files.append(DepotFileV1(self.api, item))
+        self.file_count = len(self.files)
+        self.total_size = sum(f.size or 0 for f in self.files)
 
         assert data["version"] == self.generation
         self.loaded.add("manifest")
@@ -218,6 +315,9 @@ class DepotManifestV1(GogObject):
         manifest_data = self.api.get_json(self.url)
         self.load_manifest(manifest_data)
 
+    def verify(self, target_dir, max_workers=None):
+        return verify_installation(self, target_dir, max_workers)
+
     @property
     def manifest_id(self):
         assert self.url.endswith(".json")
@@ -298,8 +398,26 @@ class RepositoryV2(GogObject):
             RepositoryProductV2(self.api, product_data)
             for product_data in repo_data["products"]]
         self.tags = set(repo_data.get("tags", []))
+        self.index = DepotIndex(self.depots)
         assert repo_data["version"] == self.generation
 
+    def select_depots(self, languages=None, bitness=None, product_ids=None,
+                      gog_depots=None, offline=False):
+        return self.index.select(
+            languages, bitness, product_ids, gog_depots, offline)
+
+    def update_manifests(self, languages=None, bitness=None, product_ids=None,
+                         gog_depots=None, offline=False,
+                         max_workers=MANIFEST_WORKERS):
+        """
+        Concurrently loads the manifests of the depots selected like in
+        DepotIndex.select and returns them
+        """
+        depots = self.select_depots(
+            languages, bitness, product_ids, gog_depots, offline)
+        load_depot_manifests(depots, max_workers)
+        return depots
+
     def __repr__(self):
         return self.simple_repr([
             "base_product_id", "client_id", "client_secret", "cloud_saves",
@@ -307,6 +425,67 @@ class RepositoryV2(GogObject):
         ])
 
 
+class DepotIndex:
+    """
+    Lookup tables over the depots of a V2 repository by language, bitness,
+    product id and GOG depot flag, built once when the repository loads
+    """
+
+    def __init__(self, depots):
+        self.depots = depots
+        self.by_language = collections.defaultdict(set)
+        self.by_bitness = collections.defaultdict(set)
+        self.by_product = collections.defaultdict(set)
+        self.gog_depots = set()
+        self.offline_depots = set()
+        for index, depot in enumerate(depots):
+            for lang in depot.languages:
+                self.by_language[lang].add(index)
+            for bitness in depot.os_bitness or ["*"]:
+                self.by_bitness[str(bitness)].add(index)
+            self.by_product[depot.product_id].add(index)
+            if depot.is_gog_depot:
+                self.gog_depots.add(index)
+            if depot.is_offline:
+                self.offline_depots.add(index)
+
+    def select(self, languages=None, bitness=None, product_ids=None,
+               gog_depots=None, offline=False):
+        """
+        Returns the depots needed for an install profile. Every criterion
+        that is None matches all depots.
+
+        languages: Any of these languages; language neutral depots always
+            match
+        bitness: "32" or "64"; depots without bitness always match
+        product_ids: Any of these products, e.g. base game and owned DLCs
+        gog_depots: True for only GOG depots, False to exclude them
+        offline: Include the offline depot
+        """
+        selected = set(range(len(self.depots)))
+        if languages is not None:
+            matches = set(self.by_language.get("*", ()))
+            for lang in languages:
+                matches.update(
+                    self.by_language.get(normalize_language(lang), ()))
+            selected &= matches
+        if bitness is not None:
+            selected &= self.by_bitness.get("*", set()) | \
+                self.by_bitness.get(str(bitness), set())
+        if product_ids is not None:
+            matches = set()
+            for product_id in product_ids:
+                matches.update(self.by_product.get(int(product_id), ()))
+            selected &= matches
+        if gog_depots is True:
+            selected &= self.gog_depots
+        elif gog_depots is False:
+            selected -= self.gog_depots
+        if not offline:
+            selected -= self.offline_depots
+        return [self.depots[index] for index in sorted(selected)]
+
+
 class CloudSaveV2(GogObject):
     generation = 2
 
@@ -359,6 +538,87 @@ class DepotV2(GogObject):
         ])
 
 
+def make_depot_item(api, depot_item, chunk_table=None):
+    if depot_item["type"] == "DepotFile":
+        return DepotFileV2(api, depot_item, chunk_table)
+    elif depot_item["type"] == "DepotDirectory":
+        return DepotDirectoryV2(api, depot_item)
+    elif depot_item["type"] == "DepotLink":
+        return DepotLinkV2(api, depot_item)
+    else:
+        raise NotImplementedError(
+            "Unknown depot item type: {}".format(depot_item["type"]))
+
+
+class ManifestItemStream:
+    """
+    Incrementally inflates and parses a compressed V2 manifest, yielding
+    the raw depot items one at a time. Everything outside of the items
+    array is collected and available as header once the stream is
+    exhausted.
+    """
+
+    def __init__(self, compressed_blocks):
+        self.blocks = iter(compressed_blocks)
+        self.inflater = zlib.decompressobj(15)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json_decoder = json.JSONDecoder()
+        self.header = None
+
+    def read_text(self):
+        for block in self.blocks:
+            text = self.decoder.decode(self.inflater.decompress(block))
+            if text:
+                return text
+        text = self.decoder.decode(self.inflater.flush(), final=True)
+        return text or None
+
+    def __iter__(self):
+        outer = []
+        buf = ""
+        # Skip to the beginning of the items array
+        while True:
+            match = ITEMS_START_RE.search(buf)
+            if match is not None:
+                outer.append(buf[:match.end()])
+                buf = buf[match.end():]
+                break
+            text = self.read_text()
+            if text is None:
+                raise ValueError("Manifest has no depot items")
+            buf += text
+
+        pos = 0
+        eof = False
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buf) and buf[pos] == "]":
+                break
+            try:
+                item, end = self.json_decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                text = self.read_text()
+                if text is None:
+                    eof = True
+                else:
+                    buf = buf[pos:] + text
+                    pos = 0
+                continue
+            yield item
+            pos = end
+
+        outer.append(buf[pos:])
+        while True:
+            text = self.read_text()
+            if text is None:
+                break
+            outer.append(text)
+        self.header = json.loads("".join(outer))
+
+
 class DepotManifestV2(GogObject):
     generation = 2
 
@@ -370,40 +630,96 @@ class DepotManifestV2(GogObject):
         self.files = []
         self.directories = []
         self.links = []
+        self.chunk_table = ChunkTable()
         for depot_item in manifest_data["depot"]["items"]:
-            if depot_item["type"] == "DepotFile":
-                self.files.append(DepotFileV2(self.api, depot_item))
-            elif depot_item["type"] == "DepotDirectory":
-                self.directories.append(DepotDirectoryV2(self.api, depot_item))
-            elif depot_item["type"] == "DepotLink":
-                self.links.append(DepotLinkV2(self.api, depot_item))
-            else:
-                raise NotImplementedError(
-                    "Unknown depot item type: {}".format(depot_item["type"]))
+            self.add_item(
+                make_depot_item(self.api, depot_item, self.chunk_table))
+        self.compute_aggregates()
+        self.load_header(manifest_data)
+
+        self.loaded.add("manifest")
+
+    def compute_aggregates(self):
+        """
+        Sums up sizes and counts once so progress reporting doesn't have to
+        walk the chunks. Must run before the small files container is
+        added to the chunk table.
+        """
+        table = self.chunk_table
+        self.file_count = len(self.files)
+        self.chunk_count = len(table)
+        self.total_size = sum(table.sizes)
+        self.compressed_size = sum(table.compressed_sizes)
+        seen = set()
+        self.unique_chunk_count = 0
+        self.unique_compressed_size = 0
+        digests = table.compressed_md5s
+        for index in range(len(table)):
+            key = bytes(digests[index * 16:index * 16 + 16])
+            if key not in seen:
+                seen.add(key)
+                self.unique_chunk_count += 1
+                self.unique_compressed_size += table.compressed_sizes[index]
+
+    def load_header(self, manifest_data):
         if "smallFilesContainer" in manifest_data["depot"]:
             self.small_files_container = DepotFileV2(
-                self.api, manifest_data["depot"]["smallFilesContainer"])
+                self.api, manifest_data["depot"]["smallFilesContainer"],
+                getattr(self, "chunk_table", None))
         assert manifest_data["version"] == self.generation
 
-        self.loaded.add("manifest")
+    def add_item(self, item):
+        if item.type == "DepotFile":
+            self.files.append(item)
+        elif item.type == "DepotDirectory":
+            self.directories.append(item)
+        else:
+            self.links.append(item)
 
     def update_manifest(self):
         manifest_data = self.api.galaxy_cs_meta(self.manifest_id)
         self.load_manifest(manifest_data)
 
+    def verify(self, target_dir, max_workers=None):
+        return verify_installation(self, target_dir, max_workers)
+
+    def iter_items(self, batch_size=None):
+        """
+        Streams the manifest without loading it, yielding depot items one
+        at a time or in lists of batch_size. The small files container is
+        available once the iterator is exhausted.
+        """
+        stream = ManifestItemStream(
+            self.api.galaxy_cs_meta_stream(self.manifest_id))
+        items = (make_depot_item(self.api, item_data) for item_data in stream)
+        if batch_size is None:
+            yield from items
+        else:
+            while True:
+                batch = list(itertools.islice(items, batch_size))
+                if not batch:
+                    break
+                yield batch
+        self.load_header(stream.header)
+
 
 class DepotFileV2(GogObject):
     generation = 2
     type = "DepotFile"
 
-    def __init__(self, api, file_data):
+    def __init__(self, api, file_data, chunk_table=None):
         super().__init__(api)
-        self.load_file(file_data)
-
-    def load_file(self, file_data):
-        self.chunks = [
-            DepotChunkV2(self.api, chunk_data)
-            for chunk_data in file_data["chunks"]]
+        self.load_file(file_data, chunk_table)
+
+    def load_file(self, file_data, chunk_table=None):
+        if chunk_table is None:
+            chunk_table = ChunkTable()
+        start = len(chunk_table)
+        for chunk_data in file_data["chunks"]:
+            chunk_table.append(chunk_data)
+        self.chunks = ChunkView(self.api, chunk_table, start, len(chunk_table))
+        self.size = sum(self.chunks.sizes)
+        self.compressed_size = sum(self.chunks.compressed_sizes)
         self.sfc_ref = file_data.get("sfcRef")
         self.flags = file_data.get("flags", [])
         self.path = file_data.get("path")
@@ -418,20 +734,85 @@ class DepotFileV2(GogObject):
         else:
             return None
 
+    def __repr__(self):
+        return self.simple_repr(["path"])
+
+
+class ChunkTable:
+    """
+    Columnar storage for the chunks of a manifest. Digests are kept as raw
+    16 byte strings and sizes in unsigned 64 bit arrays, so a chunk costs
+    48 bytes instead of a full DepotChunkV2 object.
+    """
+
+    def __init__(self):
+        self.md5s = bytearray()
+        self.compressed_md5s = bytearray()
+        self.sizes = array.array("Q")
+        self.compressed_sizes = array.array("Q")
+
+    def append(self, chunk_data):
+        self.md5s += bytes.fromhex(chunk_data["md5"])
+        self.compressed_md5s += bytes.fromhex(chunk_data["compressedMd5"])
+        self.sizes.append(chunk_data["size"])
+        self.compressed_sizes.append(chunk_data["compressedSize"])
+        return len(self.sizes) - 1
+
+    def md5(self, index):
+        return self.md5s[index * 16:index * 16 + 16].hex()
+
+    def compressed_md5(self, index):
+        return self.compressed_md5s[index * 16:index * 16 + 16].hex()
+
+    def __len__(self):
+        return len(self.sizes)
+
+
+class ChunkView(collections.abc.Sequence):
+    """
+    Read-only view over a range of a ChunkTable that creates the
+    DepotChunkV2 objects on access
+    """
+
+    def __init__(self, api, table, start, stop):
+        self.api = api
+        self.table = table
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("chunk index out of range")
+        chunk = DepotChunkV2(self.api)
+        chunk.load_table(self.table, self.start + index)
+        return chunk
+
+    @property
+    def sizes(self):
+        return self.table.sizes[self.start:self.stop]
+
     @property
-    def size(self):
-        return sum(chunk.size for chunk in self.chunks)
+    def compressed_sizes(self):
+        return self.table.compressed_sizes[self.start:self.stop]
 
     def __repr__(self):
-        return self.simple_repr(["path"])
+        return "ChunkView(start={!r}, stop={!r})".format(self.start, self.stop)
 
 
 class DepotChunkV2(GogObject):
     generation = 2
 
-    def __init__(self, api, chunk_data):
+    def __init__(self, api, chunk_data=None):
         super().__init__(api)
-        self.load_chunk(chunk_data)
+        if chunk_data is not None:
+            self.load_chunk(chunk_data)
 
     def load_chunk(self, chunk_data):
         self.compressed_md5 = chunk_data["compressedMd5"]
@@ -439,6 +820,12 @@ class DepotChunkV2(GogObject):
         self.md5 = chunk_data["md5"]
         self.size = chunk_data["size"]
 
+    def load_table(self, table, index):
+        self.compressed_md5 = table.compressed_md5(index)
+        self.compressed_size = table.compressed_sizes[index]
+        self.md5 = table.md5(index)
+        self.size = table.sizes[index]
+
     def __repr__(self):
         return self.simple_repr(
             ["compressed_md5", "compressed_size", "md5", "size"])
@@ -486,6 +873,16 @@ class SecureLinkV2(GogObject):
         self.base_url = link_data["url"]["base_url"]
         self.path = link_data["url"]["path"]
         self.token = link_data["url"]["token"]
+        self.fetched = time.time()
+
+    @property
+    def expires(self):
+        """Expiry as a unix timestamp, estimated if the token has none"""
+        match = SECURE_LINK_EXPIRES_RE.search(self.token)
+        if match is not None:
+            return int(match.group(1))
+        else:
+            return self.fetched + SECURE_LINK_LIFETIME
 
     def link_for(self, checksum):
         return "/".join((
@@ -498,3 +895,866 @@ class SecureLinkV2(GogObject):
     def __repr__(self):
         return self.simple_repr(
             ["prod_id", "type", "base_url", "path", "token"])
+
+
+class SecureLinkCache:
+    """
+    Caches secure links per (product id, path, generation). Links are
+    reused while valid and refreshed on a background thread once they are
+    within refresh_margin seconds of expiring. Only one thread fetches a
+    link per key at a time, the others wait for it and reuse its result.
+    """
+
+    def __init__(self, api, refresh_margin=SECURE_LINK_REFRESH_MARGIN):
+        self.api = api
+        self.refresh_margin = refresh_margin
+        self.lock = threading.Lock()
+        self.links = {}
+        self.key_locks = {}
+        self.refreshing = set()
+
+    def get(self, product_id, path="/", generation=2):
+        key = (int(product_id), path, generation)
+        with self.lock:
+            link = self.links.get(key)
+        remaining = link.expires - time.time() if link is not None else 0
+        if remaining <= 0:
+            return self.refresh(*key, stale=link)
+        if remaining < self.refresh_margin:
+            with self.lock:
+                start = key not in self.refreshing
+                self.refreshing.add(key)
+            if start:
+                threading.Thread(
+                    target=self.refresh, args=key, kwargs={"stale": link},
+                    daemon=True).start()
+        return link
+
+    def refresh(self, product_id, path="/", generation=2, stale=None):
+        """
+        Fetches a new link, e.g. after the old one was rejected. stale is
+        the link that should be replaced, by default the currently cached
+        one. If another thread already replaced it with a valid link, that
+        link is returned without a request.
+        """
+        key = (int(product_id), path, generation)
+        with self.lock:
+            if stale is None:
+                stale = self.links.get(key)
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                with self.lock:
+                    link = self.links.get(key)
+                if link is not None and link is not stale and \
+                        link.expires > time.time():
+                    return link
+                if generation != 2:
+                    raise NotImplementedError("V1 not implemented")
+                link_data = self.api.galaxy_secure_link(
+                    product_id, path, generation)
+                link = SecureLinkV2(self.api, link_data)
+                with self.lock:
+                    self.links[key] = link
+                return link
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def handle(self, product_id, path="/", generation=2):
+        return CachedSecureLink(self, product_id, path, generation)
+
+
+class CachedSecureLink:
+    """
+    Stand-in for a SecureLinkV2 that always uses a current link from a
+    SecureLinkCache and can be refreshed when the CDN rejects it
+    """
+
+    def __init__(self, cache, product_id, path="/", generation=2):
+        self.cache = cache
+        self.key = (product_id, path, generation)
+
+    @property
+    def link(self):
+        return self.cache.get(*self.key)
+
+    def refresh(self, stale=None):
+        """stale: The link that was rejected, see SecureLinkCache.refresh"""
+        return self.cache.refresh(*self.key, stale=stale)
+
+    def link_for(self, checksum):
+        return self.link.link_for(checksum)
+
+    def link_for_chunk(self, chunk):
+        return self.link.link_for_chunk(chunk)
+
+    def __repr__(self):
+        return "CachedSecureLink(product_id={!r}, path={!r}, " \
+            "generation={!r})".format(*self.key)
+
+
+########################################
+# Deltas
+########################################
+
+class ReusedChunk:
+    def __init__(self, offset, source_path, source_offset, size):
+        self.offset = offset
+        self.source_path = source_path
+        self.source_offset = source_offset
+        self.size = size
+
+    def __repr__(self):
+        return "ReusedChunk(offset={!r}, source_path={!r}, " \
+            "source_offset={!r}, size={!r})".format(
+                self.offset, self.source_path, self.source_offset, self.size)
+
+
+class FilePatch:
+    """
+    Describes how to build a changed file: reused chunks are copied from
+    the old installation, fetched chunks have to be downloaded.
+    """
+
+    def __init__(self, depot_file):
+        self.file = depot_file
+        self.reused = []
+        self.fetched = []
+
+    def __repr__(self):
+        return "FilePatch(path={!r}, reused={}, fetched={})".format(
+            self.file.path, len(self.reused), len(self.fetched))
+
+
+class BuildDelta:
+    """
+    Difference between two sets of V2 depot manifests, compared by path
+    and chunk md5. A path in several depots of a set is taken from the
+    last one, as DepotDownloader does.
+
+    unchanged: Files whose chunks are identical
+    patched: FilePatch for every changed file that reuses old chunks
+    added: FilePatch for every file that has to be downloaded completely
+    removed: Paths that only exist in the old build
+    chunks: Chunks that need downloading, by compressed md5
+    """
+
+    def __init__(self, old_manifests, new_manifests):
+        self.unchanged = []
+        self.patched = []
+        self.added = []
+        self.removed = []
+        self.chunks = {}
+        self.compare(old_manifests, new_manifests)
+
+    def compare(self, old_manifests, new_manifests):
+        old_files = files_by_path(old_manifests)
+        old_chunks = {}
+        for depot_file in old_files.values():
+            view = depot_file.chunks
+            offset = 0
+            for index in range(view.start, view.stop):
+                digest = view.table.md5s[index * 16:index * 16 + 16]
+                size = view.table.sizes[index]
+                old_chunks.setdefault(bytes(digest), (depot_file.path, offset))
+                offset += size
+
+        new_files = files_by_path(new_manifests)
+        for depot_file in new_files.values():
+            old_file = old_files.get(depot_file.path)
+            if old_file is not None and \
+                    chunk_digests(old_file) == chunk_digests(depot_file):
+                self.unchanged.append(depot_file)
+                continue
+
+            patch = FilePatch(depot_file)
+            offset = 0
+            for chunk in depot_file.chunks:
+                source = old_chunks.get(bytes.fromhex(chunk.md5))
+                if source is None:
+                    patch.fetched.append((offset, chunk))
+                    self.chunks.setdefault(chunk.compressed_md5, chunk)
+                else:
+                    patch.reused.append(ReusedChunk(
+                        offset, source[0], source[1], chunk.size))
+                offset += chunk.size
+            if patch.reused:
+                self.patched.append(patch)
+            else:
+                self.added.append(patch)
+
+        self.removed = [path for path in old_files if path not in new_files]
+
+    @property
+    def download_size(self):
+        return sum(chunk.compressed_size for chunk in self.chunks.values())
+
+    def __repr__(self):
+        return "BuildDelta(unchanged={}, patched={}, added={}, removed={}, " \
+            "chunks={})".format(
+                len(self.unchanged), len(self.patched), len(self.added),
+                len(self.removed), len(self.chunks))
+
+
+def files_by_path(manifests):
+    """
+    Depot files of several manifests by path. A path that is in more than
+    one depot maps to the file of the last one, like when downloading.
+    """
+    files = {}
+    for manifest in manifests:
+        for depot_file in manifest.files:
+            files[depot_file.path] = depot_file
+    return files
+
+def chunk_digests(depot_file):
+    view = depot_file.chunks
+    return view.table.md5s[view.start * 16:view.stop * 16]
+
+
+########################################
+# Verification
+########################################
+
+def hash_range(task):
+    """Returns the md5 of a file range or None if it can't be read"""
+    path, offset, size = task
+    md5 = hashlib.md5()
+    try:
+        with open(path, "rb") as fobj:
+            fobj.seek(offset)
+            remaining = size
+            while remaining > 0:
+                block = fobj.read(min(remaining, HASH_BLOCK_SIZE))
+                if not block:
+                    return None
+                md5.update(block)
+                remaining -= len(block)
+    except OSError:
+        return None
+    return md5.hexdigest()
+
+
+class VerifyResult:
+    """
+    missing: Depot paths of files that don't exist
+    corrupt: Depot paths of files with a wrong size or checksum
+    extra: Local paths of files that aren't part of any manifest
+    """
+
+    def __init__(self):
+        self.missing = []
+        self.corrupt = []
+        self.extra = []
+
+    @property
+    def ok(self):
+        return not (self.missing or self.corrupt or self.extra)
+
+    def __repr__(self):
+        return "VerifyResult(missing={}, corrupt={}, extra={})".format(
+            len(self.missing), len(self.corrupt), len(self.extra))
+
+
+def verify_installation(manifests, target_dir, max_workers=None):
+    """
+    Checks an installation against a loaded DepotManifestV1 or
+    DepotManifestV2, or a list of them for an installation made of
+    several depots, hashing on a pool of max_workers processes. A path in
+    several depots is checked against the last one. Files of more than
+    one V2 chunk are hashed chunk by chunk, so large files are spread over
+    several processes too.
+    """
+    if isinstance(manifests, (DepotManifestV1, DepotManifestV2)):
+        manifests = [manifests]
+    result = VerifyResult()
+    known_paths = set()
+    tasks = {}
+    corrupt = set()
+    for manifest in manifests:
+        for link in manifest.links:
+            known_paths.add(
+                os.path.normcase(local_path(target_dir, link.path)))
+    for depot_file in files_by_path(manifests).values():
+        path = local_path(target_dir, depot_file.path)
+        known_paths.add(os.path.normcase(path))
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            result.missing.append(depot_file.path)
+            continue
+        if depot_file.size is not None and stat.st_size != depot_file.size:
+            corrupt.add(depot_file.path)
+            continue
+
+        if depot_file.generation == 2 and len(depot_file.chunks) > 1:
+            view = depot_file.chunks
+            offset = 0
+            for index in range(view.start, view.stop):
+                size = view.table.sizes[index]
+                tasks[(path, offset, size)] = (
+                    depot_file.path, view.table.md5(index))
+                offset += size
+        elif depot_file.checksum:
+            tasks[(path, 0, stat.st_size)] = (
+                depot_file.path, depot_file.checksum)
+
+    for task, digest in run_parallel(
+            hash_range, tasks, max_workers or os.cpu_count() or 1,
+            executor_class=ProcessPoolExecutor):
+        depot_path, expected = tasks[task]
+        if digest != expected:
+            corrupt.add(depot_path)
+    result.corrupt = sorted(corrupt)
+
+    for dirpath, dirnames, filenames in os.walk(target_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if os.path.normcase(path) not in known_paths:
+                result.extra.append(path)
+    return result
+
+
+########################################
+# Downloading
+########################################
+
+def local_path(target_dir, depot_path):
+    """Maps a depot path with either separator to a path below target_dir"""
+    parts = depot_path.replace("\\", "/").split("/")
+    return os.path.join(target_dir, *parts)
+
+def is_link_expired(error):
+    return isinstance(error, requests.HTTPError) and \
+        error.response is not None and \
+        error.response.status_code in LINK_EXPIRED_STATUS
+
+def make_parent_dirs(path):
+    """Creates the directory of path, if it has one"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+def check_md5(data, expected):
+    actual = hashlib.md5(data).hexdigest()
+    if actual != expected:
+        raise ChecksumError(
+            "Checksum mismatch: expected {}, got {}".format(expected, actual))
+
+
+class FileAssembler:
+    """
+    Writes chunks into preallocated files at their offsets with positional
+    writes, so chunks can be written in whatever order they arrive. Files
+    are opened on their first write and closed once all of their expected
+    chunks have been written. With durable set, files are fsynced before
+    they are closed.
+    """
+
+    def __init__(self, sparse=False, durable=False):
+        self.sparse = sparse
+        self.durable = durable
+        self.lock = threading.Lock()
+        self.files = {} # path -> [fd or None, remaining chunks, write lock]
+
+    def add(self, path, size, chunk_count):
+        """Creates and preallocates a file that expects chunk_count writes"""
+        make_parent_dirs(path)
+        fd = os.open(path, self.open_flags, 0o644)
+        try:
+            self.preallocate(fd, size)
+        finally:
+            os.close(fd)
+        if chunk_count > 0:
+            with self.lock:
+                self.files[path] = [None, chunk_count, threading.Lock()]
+
+    @property
+    def open_flags(self):
+        return os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+
+    def preallocate(self, fd, size):
+        os.ftruncate(fd, size)
+        if not self.sparse and size > 0 and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                pass # Not supported by the file system, stay sparse
+
+    def write(self, path, offset, data):
+        """Returns True if this was the last chunk of the file"""
+        with self.lock:
+            entry = self.files[path]
+        with entry[2]:
+            if entry[0] is None:
+                entry[0] = os.open(path, self.open_flags)
+            fd = entry[0]
+            if not hasattr(os, "pwrite"):
+                os.lseek(fd, offset, os.SEEK_SET)
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+        if hasattr(os, "pwrite"):
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+
+        with self.lock:
+            entry[1] -= 1
+            finished = entry[1] == 0
+            if finished:
+                del self.files[path]
+        if finished:
+            with entry[2]:
+                if self.durable:
+                    os.fsync(fd)
+                os.close(fd)
+                entry[0] = None
+        return finished
+
+    def sync(self):
+        """fsyncs all open files"""
+        with self.lock:
+            entries = list(self.files.values())
+        for entry in entries:
+            with entry[2]:
+                if entry[0] is not None:
+                    os.fsync(entry[0])
+
+    def close(self):
+        with self.lock:
+            entries = list(self.files.values())
+            self.files.clear()
+        for entry in entries:
+            with entry[2]:
+                if entry[0] is not None:
+                    os.close(entry[0])
+                    entry[0] = None
+
+
+class DownloadPlan:
+    """
+    Collapses the chunks of a set of depot files, possibly from several
+    depots, to the unique chunks by compressed md5. Every unique chunk is
+    fetched once and written to all of its targets.
+
+    files: local path -> (depot file, pending chunk count)
+    chunks: compressed md5 -> (chunk table, index, targets), where targets
+        are (depot path, local path, offset) tuples
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.chunks = {}
+        self.references = 0
+
+    def add_file(self, depot_file, path, journal=None):
+        """
+        Adds the chunks of depot_file that are missing from journal. If a
+        file with the same local path was added before, e.g. from another
+        language depot, it is replaced, so the last depot wins.
+        """
+        if path in self.files:
+            logger.debug(
+                "%s is in several depots, using the last one", depot_file.path)
+            self.remove_file(path)
+        view = depot_file.chunks
+        table = view.table
+        pending = 0
+        offset = 0
+        for index in range(view.start, view.stop):
+            if journal is None or \
+                    not journal.has_chunk(depot_file.path, offset):
+                key = bytes(table.compressed_md5s[index * 16:index * 16 + 16])
+                entry = self.chunks.get(key)
+                if entry is None:
+                    entry = (table, index, [])
+                    self.chunks[key] = entry
+                entry[2].append((depot_file.path, path, offset))
+                pending += 1
+            offset += table.sizes[index]
+        self.files[path] = (depot_file, pending)
+        self.references += pending
+
+    def remove_file(self, path):
+        """Drops the file at local path and its chunk targets"""
+        depot_file, pending = self.files.pop(path)
+        view = depot_file.chunks
+        table = view.table
+        for index in range(view.start, view.stop):
+            key = bytes(table.compressed_md5s[index * 16:index * 16 + 16])
+            entry = self.chunks.get(key)
+            if entry is None:
+                continue
+            entry[2][:] = [target for target in entry[2] if target[1] != path]
+            if not entry[2]:
+                del self.chunks[key]
+        self.references -= pending
+
+    @property
+    def download_size(self):
+        return sum(
+            table.compressed_sizes[index]
+            for table, index, targets in self.chunks.values())
+
+    def __repr__(self):
+        return "DownloadPlan(files={}, chunks={}, references={})".format(
+            len(self.files), len(self.chunks), self.references)
+
+
+class DepotDownloader:
+    """
+    Downloads the files of content system V2 depots, fetching chunks on
+    a bounded pool of worker threads.
+    """
+
+    def __init__(self, api, secure_link, max_workers=DOWNLOAD_WORKERS,
+                 chunk_store=None, job=None, retries=CHUNK_RETRIES):
+        """
+        secure_link: SecureLinkV2, or a CachedSecureLink to refresh
+            expired links automatically
+        retries: Attempts per chunk before the download is aborted
+        chunk_store: Optional gogapi.cache.ChunkStore that is consulted
+            before a chunk is fetched
+        job: Optional gogapi.transfer.DownloadJob to share bandwidth and
+            connections with other downloads
+        """
+        self.api = api
+        self.secure_link = secure_link
+        self.max_workers = max_workers
+        self.chunk_store = chunk_store
+        self.job = job
+        self.retries = retries
+
+    def fetch_chunk(self, chunk):
+        """Downloads, verifies and inflates a single chunk"""
+        data = None
+        if self.chunk_store is not None:
+            data = self.chunk_store.get(chunk.compressed_md5)
+        if data is None:
+            data = self.fetch_compressed(chunk)
+            if self.chunk_store is not None:
+                self.chunk_store.put(chunk.compressed_md5, data)
+        data = zlib.decompress(data, 15)
+        check_md5(data, chunk.md5)
+        return data
+
+    def fetch_compressed(self, chunk):
+        """
+        Downloads and verifies a compressed chunk, retrying failed attempts
+        up to self.retries times in total. A rejected CachedSecureLink is
+        refreshed before the next attempt.
+        """
+        for attempt in range(self.retries):
+            # Pin the link, so a rejection only refreshes it if no other
+            # worker has done so already
+            link = self.secure_link
+            if isinstance(link, CachedSecureLink):
+                link = link.link
+            try:
+                data = transfer.fetch(
+                    self.api, link.link_for_chunk(chunk), self.job)
+                check_md5(data, chunk.compressed_md5)
+                return data
+            except (GogError, requests.RequestException) as e:
+                if attempt == self.retries - 1:
+                    raise
+                logger.warning(
+                    "Retrying chunk %s: %s", chunk.compressed_md5, e)
+                if is_link_expired(e) and \
+                        isinstance(self.secure_link, CachedSecureLink):
+                    self.secure_link.refresh(link)
+
+    def download(self, files, target_dir, small_files_container=None,
+                 journal=None):
+        """
+        files: DepotManifestV2, a list of DepotManifestV2 or a list of
+            DepotFileV2. Chunks shared between files or depots are only
+            fetched once.
+        target_dir: Directory the depot paths are relative to
+        small_files_container: Container DepotFileV2 for files with an
+            sfc_ref, taken from the manifests if not given
+        journal: Optional gogapi.journal.DownloadJournal, chunks and files
+            recorded in it are skipped and new ones are added
+        """
+        if isinstance(files, DepotManifestV2):
+            files = [files]
+        if files and all(isinstance(m, DepotManifestV2) for m in files):
+            groups = []
+            for manifest in files:
+                for directory in manifest.directories:
+                    os.makedirs(
+                        local_path(target_dir, directory.path), exist_ok=True)
+                groups.append((manifest.files, getattr(
+                    manifest, "small_files_container", small_files_container)))
+        else:
+            groups = [(files, small_files_container)]
+
+        plan = DownloadPlan()
+        for group_files, container in groups:
+            if journal is not None:
+                group_files = [
+                    f for f in group_files if not journal.has_file(f.path)]
+            if container is not None:
+                small_files = [f for f in group_files if f.sfc_ref]
+                group_files = [f for f in group_files if not f.sfc_ref]
+                if small_files:
+                    self.download_small_files(
+                        container, small_files, target_dir, journal)
+            for depot_file in group_files:
+                plan.add_file(
+                    depot_file, local_path(target_dir, depot_file.path),
+                    journal)
+        self.download_plan(plan, journal)
+
+    def download_plan(self, plan, journal=None):
+        logger.debug("Executing %r", plan)
+        assembler = FileAssembler(durable=journal is not None)
+        try:
+            for path, (depot_file, pending) in plan.files.items():
+                assembler.add(path, depot_file.size, pending)
+                if pending == 0 and journal is not None:
+                    journal.add_file(depot_file.path)
+            written = 0
+            for key, _ in run_parallel(
+                    lambda key: self.download_chunk(
+                        assembler, journal, plan.chunks[key]),
+                    plan.chunks, self.max_workers):
+                written += 1
+                if journal is not None and \
+                        written % JOURNAL_COMMIT_INTERVAL == 0:
+                    journal.commit(assembler.sync)
+        finally:
+            if journal is not None:
+                journal.commit(assembler.sync)
+            assembler.close()
+
+    def download_small_files(self, container, files, target_dir,
+                             journal=None):
+        """
+        Fetches only the chunks of the small files container that are
+        referenced by files and slices the files out of them. Chunks are
+        fetched in order in batches, every file is written as soon as its
+        chunks are there and chunks are released once no pending file
+        needs them.
+        """
+        starts = list(itertools.accumulate(container.chunks.sizes[:-1]))
+        starts.insert(0, 0)
+        pending = [] # (first chunk, last chunk, file) by offset
+        for depot_file in files:
+            offset = depot_file.sfc_ref["offset"]
+            size = depot_file.sfc_ref["size"]
+            first = bisect.bisect_right(starts, offset) - 1
+            if size == 0:
+                last = first - 1
+            else:
+                last = bisect.bisect_right(starts, offset + size - 1) - 1
+            pending.append((first, last, depot_file))
+        pending.sort(key=lambda entry: entry[2].sfc_ref["offset"])
+        needed = sorted(set(itertools.chain.from_iterable(
+            range(first, last + 1) for first, last, _ in pending)))
+
+        logger.debug(
+            "Fetching %s of %s small files container chunks",
+            len(needed), len(container.chunks))
+        container_data = {}
+        position = 0
+        batch_size = self.max_workers * 2
+        # Ends with an empty batch that writes the remaining empty files
+        for batch_start in range(0, len(needed) + batch_size, batch_size):
+            batch = needed[batch_start:batch_start + batch_size]
+            for index, data in run_parallel(
+                    lambda index: self.fetch_chunk(container.chunks[index]),
+                    batch, self.max_workers):
+                container_data[index] = data
+            fetched = batch[-1] if batch else len(starts)
+            while position < len(pending) and \
+                    pending[position][1] <= fetched:
+                first, last, depot_file = pending[position]
+                self.write_small_file(
+                    depot_file, starts, container_data, target_dir, journal)
+                position += 1
+            if position < len(pending):
+                keep = pending[position][0]
+            else:
+                keep = len(starts)
+            for index in [i for i in container_data if i < keep]:
+                del container_data[index]
+
+    def write_small_file(self, depot_file, starts, container_data,
+                         target_dir, journal=None):
+        offset = depot_file.sfc_ref["offset"]
+        end = offset + depot_file.sfc_ref["size"]
+        parts = []
+        index = bisect.bisect_right(starts, offset) - 1
+        while offset < end:
+            chunk_start = starts[index]
+            chunk_data = container_data[index]
+            part_end = min(end, chunk_start + len(chunk_data))
+            parts.append(
+                chunk_data[offset - chunk_start:part_end - chunk_start])
+            offset = part_end
+            index += 1
+        data = b"".join(parts)
+        if depot_file.checksum:
+            check_md5(data, depot_file.checksum)
+
+        path = local_path(target_dir, depot_file.path)
+        make_parent_dirs(path)
+        with open(path, "wb") as fobj:
+            fobj.write(data)
+            if journal is not None:
+                fobj.flush()
+                os.fsync(fobj.fileno())
+        if journal is not None:
+            journal.add_file(depot_file.path)
+
+    def download_chunk(self, assembler, journal, plan_entry):
+        table, index, targets = plan_entry
+        chunk = DepotChunkV2(self.api)
+        chunk.load_table(table, index)
+        data = self.fetch_chunk(chunk)
+        for depot_path, path, offset in targets:
+            finished = assembler.write(path, offset, data)
+            if journal is not None:
+                journal.add_chunk(depot_path, offset)
+                if finished:
+                    journal.add_file(depot_path)
+
+
+class DepotDownloaderV1:
+    """
+    Downloads generation 1 depot files, which are slices of larger blobs.
+    Slices are sorted by (url, offset) and adjacent or nearly adjacent
+    ones are fetched with a single HTTP range request whose stream is
+    split back into the files.
+    """
+
+    def __init__(self, api, base_url, max_workers=DOWNLOAD_WORKERS,
+                 max_gap=RANGE_MAX_GAP, max_span=RANGE_MAX_SPAN, job=None,
+                 retries=CHUNK_RETRIES):
+        """
+        base_url: URL the file urls are relative to, may include a query
+            string with an access token
+        retries: Attempts per range request before the download is aborted
+        """
+        self.api = api
+        self.base_url = base_url
+        self.max_workers = max_workers
+        self.max_gap = max_gap
+        self.max_span = max_span
+        self.job = job
+        self.retries = retries
+
+    def link_for(self, file_url):
+        base, _, query = self.base_url.partition("?")
+        url = base.rstrip("/") + "/" + urllib.parse.quote(file_url.lstrip("/"))
+        if query:
+            url += "?" + query
+        return url
+
+    def plan_spans(self, files):
+        """Returns (url, start, end, files) with end exclusive"""
+        slices = sorted(
+            (f for f in files if f.size),
+            key=lambda f: (f.url, f.offset))
+        spans = []
+        for depot_file in slices:
+            file_end = depot_file.offset + depot_file.size
+            if spans:
+                url, start, end, span_files = spans[-1]
+                if url == depot_file.url and \
+                        depot_file.offset - end <= self.max_gap and \
+                        file_end - start <= self.max_span:
+                    spans[-1] = (url, start, max(end, file_end), span_files)
+                    span_files.append(depot_file)
+                    continue
+            spans.append(
+                (depot_file.url, depot_file.offset, file_end, [depot_file]))
+        return spans
+
+    def download(self, files, target_dir):
+        """files: DepotManifestV1 or a list of DepotFileV1"""
+        if isinstance(files, DepotManifestV1):
+            for directory in files.dirs:
+                os.makedirs(
+                    local_path(target_dir, directory.path), exist_ok=True)
+            files = files.files
+
+        for depot_file in files:
+            if not depot_file.size:
+                path = local_path(target_dir, depot_file.path)
+                make_parent_dirs(path)
+                open(path, "wb").close()
+
+        spans = self.plan_spans(files)
+        logger.debug(
+            "Downloading %s V1 files in %s range requests",
+            sum(len(span[3]) for span in spans), len(spans))
+        for span, _ in run_parallel(
+                lambda span: self.download_span(span, target_dir),
+                spans, self.max_workers):
+            pass
+
+    def download_span(self, span, target_dir):
+        """Downloads a span, retrying it as a whole if it fails"""
+        for attempt in range(self.retries):
+            try:
+                return self.fetch_span(span, target_dir)
+            except (GogError, requests.RequestException) as e:
+                if attempt == self.retries - 1:
+                    raise
+                logger.warning(
+                    "Retrying range %s-%s of %s: %s",
+                    span[1], span[2], span[0], e)
+
+    def fetch_span(self, span, target_dir):
+        url, start, end, files = span
+        writers = [None] * len(files)
+        first = 0
+        pos = start
+        stream = transfer.iter_content(
+            self.api, self.link_for(url), self.job,
+            headers=transfer.range_header(start, end - 1))
+        try:
+            for block in stream:
+                block_end = pos + len(block)
+                index = first
+                while index < len(files) and files[index].offset < block_end:
+                    depot_file = files[index]
+                    file_end = depot_file.offset + depot_file.size
+                    if writers[index] != "done" and file_end > pos:
+                        if writers[index] is None:
+                            path = local_path(target_dir, depot_file.path)
+                            make_parent_dirs(path)
+                            writers[index] = (open(path, "wb"), hashlib.md5())
+                        fobj, md5 = writers[index]
+                        part = block[
+                            max(depot_file.offset, pos) - pos:
+                            min(file_end, block_end) - pos]
+                        fobj.write(part)
+                        md5.update(part)
+                        if file_end <= block_end:
+                            fobj.close()
+                            writers[index] = "done"
+                            if depot_file.checksum and \
+                                    md5.hexdigest() != depot_file.checksum:
+                                raise ChecksumError(
+                                    "Checksum mismatch for {}".format(
+                                        depot_file.path))
+                    index += 1
+                while first < len(files) and writers[first] == "done":
+                    first += 1
+                pos = block_end
+        finally:
+            # Releases the response and its DownloadJob connection
+            stream.close()
+            for writer in writers:
+                if writer not in (None, "done"):
+                    writer[0].close()
+        if first < len(files):
+            raise GogError("Range {}-{} of {} ended early".format(
+                start, end, url))
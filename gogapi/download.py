@@ -1,8 +1,31 @@
+import io
+import os
+import re
+import sys
+import array
+import hashlib
+import collections.abc
+from datetime import datetime
 import dateutil.parser
 import xml.etree.ElementTree as ETree
 
-from gogapi.base import GogObject
+import requests
 
+from gogapi import transfer
+from gogapi.base import (
+    GogObject, GogError, ChecksumError, logger, run_parallel)
+from gogapi.contentsystem import (
+    FileAssembler, CHUNK_RETRIES, hash_range, is_link_expired)
+
+DOWNLOAD_WORKERS = 8
+LINK_WORKERS = 16
+# Range size for files without a chunklist, GOG's chunklists use 10 MiB
+FALLBACK_CHUNK_SIZE = 10 * 1024 * 1024
+FILE_TAG_RE = re.compile(rb"<file\b[^>]*>")
+CHUNK_RE = re.compile(
+    rb'<chunk id="(\d+)" from="(\d+)" to="(\d+)" method="(\w+)">\s*'
+    rb'([0-9a-fA-F]{32})\s*</chunk>')
+TIMESTAMP_RE = re.compile(r"(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)$")
 
 
 class Download(GogObject):
@@ -15,6 +38,7 @@ class Download(GogObject):
         self.id = str(data["id"])
         self.name = data["name"]
         self.files = [File(self.api, file_data) for file_data in data["files"]]
+        self.total_size = sum(f.size for f in self.files)
 
         # installers
         self.os = data.get("os")
@@ -25,9 +49,8 @@ class Download(GogObject):
         self.bonus_type = data.get("type")
         self.count = data.get("count")
 
-    @property
-    def total_size(self):
-        return sum(f.size for f in self.files)
+    def update_files(self, chunklists=True, max_workers=LINK_WORKERS):
+        return update_files(self.files, chunklists, max_workers)
 
 
 class File(GogObject):
@@ -47,24 +70,47 @@ class File(GogObject):
         self.loaded.add("infolink")
 
     def load_chunklist(self, tree):
-        self.filename = tree.attrib["name"]
-        self.available = bool(int(tree.attrib["available"]))
-        self.notavailablemsg = tree.attrib["notavailablemsg"]
-        self.md5 = tree.attrib["md5"]
-        self.timestamp = dateutil.parser.parse(tree.attrib["timestamp"])
-        self.chunks = []
-
+        self.load_chunklist_attrib(tree.attrib)
         for chunk_elem in tree:
-            self.chunks.append(Chunk(
-                chunk_id=int(chunk_elem.attrib["id"]),
-                start=int(chunk_elem.attrib["from"]),
-                end=int(chunk_elem.attrib["to"]),
-                method=chunk_elem.attrib["method"],
-                digest=chunk_elem.text
-            ))
+            self.chunks.append(chunk_elem.attrib, chunk_elem.text)
 
         self.loaded.add("chunklist")
 
+    def load_chunklist_xml(self, xml_data):
+        """
+        Loads the chunklist without building a tree. Chunk elements in
+        the fixed format GOG generates are matched directly, anything else
+        is streamed with iterparse.
+        """
+        chunks = ChunkList()
+        file_tag = FILE_TAG_RE.search(xml_data)
+        matches = CHUNK_RE.findall(xml_data)
+        if file_tag is not None and \
+                len(matches) == xml_data.count(b"<chunk"):
+            header = xml_data[:file_tag.end()]
+            if not header.endswith(b"/>"):
+                header += b"</file>"
+            self.load_chunklist_attrib(ETree.fromstring(header).attrib)
+            chunks.extend_matches(matches)
+        else:
+            for event, elem in ETree.iterparse(io.BytesIO(xml_data)):
+                if elem.tag == "chunk":
+                    chunks.append(elem.attrib, elem.text)
+                    elem.clear()
+                elif elem.tag == "file":
+                    self.load_chunklist_attrib(elem.attrib)
+        self.chunks = chunks
+
+        self.loaded.add("chunklist")
+
+    def load_chunklist_attrib(self, attrib):
+        self.filename = attrib["name"]
+        self.available = bool(int(attrib["available"]))
+        self.notavailablemsg = attrib["notavailablemsg"]
+        self.md5 = attrib["md5"]
+        self.timestamp = parse_timestamp(attrib["timestamp"])
+        self.chunks = ChunkList()
+
     def update_infolink(self):
         infolink_data = self.api.get_json(self.infolink)
         self.load_infolink(infolink_data)
@@ -72,9 +118,94 @@ class File(GogObject):
     def update_chunklist(self):
         if "infolink" not in self.loaded:
             self.update_infolink()
-        xml_text = self.api.get(self.chunklink).text
-        tree = ETree.fromstring(xml_text)
-        self.load_chunklist(tree)
+        self.load_chunklist_xml(self.api.get(self.chunklink).content)
+
+    def download(self, path, max_workers=DOWNLOAD_WORKERS, job=None):
+        downloader = InstallerDownloader(self.api, max_workers, job=job)
+        downloader.download(self, path)
+
+    def repair(self, path, max_workers=DOWNLOAD_WORKERS, job=None):
+        downloader = InstallerDownloader(self.api, max_workers, job=job)
+        return downloader.repair(self, path)
+
+def update_files(files, chunklists=True, max_workers=LINK_WORKERS):
+    """
+    Resolves the infolinks and optionally the chunklists of many files
+    concurrently. Files that fail, e.g. because they have no chunklist,
+    are logged and returned.
+    """
+    def update(fileobj):
+        try:
+            if "infolink" not in fileobj.loaded:
+                fileobj.update_infolink()
+            if chunklists and "chunklist" not in fileobj.loaded:
+                fileobj.update_chunklist()
+        except (requests.RequestException, ETree.ParseError, ValueError,
+                KeyError) as e:
+            logger.warning("Failed to update file %s: %s", fileobj.id, e)
+            return False
+        return True
+
+    return [
+        fileobj for fileobj, success in run_parallel(
+            update, files, max_workers)
+        if not success]
+
+def parse_timestamp(text):
+    # Chunklists always use the same format, skip the generic parser
+    match = TIMESTAMP_RE.match(text)
+    if match is not None:
+        return datetime(*(int(group) for group in match.groups()))
+    else:
+        return dateutil.parser.parse(text)
+
+
+class ChunkList(collections.abc.Sequence):
+    """
+    Compact chunklist storage with offsets in array('Q') and raw md5
+    digests in a bytearray. Chunk objects are created on access.
+    """
+
+    def __init__(self):
+        self.ids = array.array("Q")
+        self.starts = array.array("Q")
+        self.ends = array.array("Q")
+        self.digests = bytearray()
+        self.methods = []
+
+    def append(self, attrib, digest):
+        self.ids.append(int(attrib["id"]))
+        self.starts.append(int(attrib["from"]))
+        self.ends.append(int(attrib["to"]))
+        self.methods.append(sys.intern(attrib["method"]))
+        self.digests += bytes.fromhex(digest.strip())
+
+    def extend_matches(self, matches):
+        """Adds (id, from, to, method, digest) tuples of bytes"""
+        for chunk_id, start, end, method, digest in matches:
+            self.ids.append(int(chunk_id))
+            self.starts.append(int(start))
+            self.ends.append(int(end))
+            self.methods.append(sys.intern(method.decode("ascii")))
+            self.digests += bytes.fromhex(digest.decode("ascii"))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("chunk index out of range")
+        return Chunk(
+            chunk_id=self.ids[index],
+            start=self.starts[index],
+            end=self.ends[index],
+            method=self.methods[index],
+            digest=self.digests[index * 16:index * 16 + 16].hex())
+
 
 class Chunk:
     def __init__(self, chunk_id, start, end, method, digest):
@@ -89,3 +220,133 @@ class Chunk:
             "Chunk(chunk_id={}, start={}, end={}, method='{}', digest='{}')"
         return CHUNKFORMAT.format(
             self.id, self.start, self.end, self.method, self.digest)
+
+
+class InstallerDownloader:
+    """
+    Downloads installer files with parallel range requests aligned to the
+    chunks of their chunklist, verifying every chunk as it lands and
+    retrying only the chunks that failed
+    """
+
+    def __init__(self, api, max_workers=DOWNLOAD_WORKERS,
+                 retries=CHUNK_RETRIES, job=None):
+        self.api = api
+        self.max_workers = max_workers
+        self.retries = retries
+        self.job = job
+
+    def load_chunklist(self, file):
+        """Loads the chunklist of file if needed, False if it has none"""
+        if "chunklist" in file.loaded:
+            return True
+        if "infolink" not in file.loaded:
+            file.update_infolink()
+        if not file.chunklink:
+            return False
+        try:
+            file.update_chunklist()
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            logger.debug("No chunklist for file %s", file.id)
+            return False
+        return True
+
+    def download(self, file, path, chunks=None):
+        """
+        Downloads file to path, or only the given chunks of its chunklist
+        into an existing file. Files without a chunklist are fetched in
+        unverified ranges of FALLBACK_CHUNK_SIZE. Returns the downloaded
+        chunks.
+        """
+        if chunks is None:
+            if self.load_chunklist(file) and file.chunks:
+                chunks = list(file.chunks)
+            else:
+                chunks = [
+                    Chunk(index, start,
+                          min(start + FALLBACK_CHUNK_SIZE, file.size) - 1,
+                          None, None)
+                    for index, start in enumerate(
+                        range(0, file.size, FALLBACK_CHUNK_SIZE))]
+        elif "infolink" not in file.loaded:
+            file.update_infolink()
+
+        assembler = FileAssembler()
+        assembler.add(path, file.size, len(chunks))
+        try:
+            pending = chunks
+            for attempt in range(self.retries):
+                if not pending:
+                    break
+                if attempt > 0:
+                    logger.warning(
+                        "Retrying %s chunks of %s", len(pending), path)
+                failed = []
+                link_expired = False
+                for chunk, error in run_parallel(
+                        lambda chunk: self.download_chunk(
+                            assembler, file, path, chunk),
+                        pending, self.max_workers):
+                    if error is not None:
+                        failed.append(chunk)
+                        link_expired |= is_link_expired(error)
+                if link_expired:
+                    file.update_infolink()
+                pending = failed
+            if pending:
+                raise GogError("{} chunks of {} failed".format(
+                    len(pending), path))
+        finally:
+            assembler.close()
+        return chunks
+
+    def repair(self, file, path):
+        """
+        Hashes a partially downloaded or corrupt installer chunk by chunk
+        on all cores and downloads only the chunks that don't match.
+        Returns the repaired chunks. Chunks that can't be verified are
+        only downloaded again if the file doesn't cover them.
+        """
+        if not self.load_chunklist(file) or not file.chunks or \
+                not os.path.exists(path):
+            return self.download(file, path)
+
+        local_size = os.path.getsize(path)
+        tasks = {}
+        broken = []
+        for chunk in file.chunks:
+            if chunk.method == "md5":
+                tasks[(path, chunk.start, chunk.end - chunk.start + 1)] = chunk
+            elif chunk.end >= local_size:
+                broken.append(chunk)
+        broken.extend(
+            tasks[task] for task, digest in run_parallel(
+                hash_range, tasks, os.cpu_count() or 1)
+            if digest != tasks[task].digest)
+        broken.sort(key=lambda chunk: chunk.start)
+        logger.debug(
+            "Repairing %s of %s chunks of %s",
+            len(broken), len(file.chunks), path)
+        if broken:
+            self.download(file, path, broken)
+        return broken
+
+    def download_chunk(self, assembler, file, path, chunk):
+        """Returns the error instead of raising it, so it can be retried"""
+        try:
+            data = transfer.fetch(
+                self.api, file.securelink, self.job,
+                headers=transfer.range_header(chunk.start, chunk.end))
+            if len(data) != chunk.end - chunk.start + 1:
+                raise GogError("Short read for chunk {}".format(chunk.id))
+            if chunk.method == "md5" and \
+                    hashlib.md5(data).hexdigest() != chunk.digest:
+                raise ChecksumError("Checksum mismatch for chunk {}".format(
+                    chunk.id))
+        except (GogError, requests.RequestException) as e:
+            logger.debug("Chunk %s of %s failed: %s", chunk.id, path, e)
+            return e
+        assembler.write(path, chunk.start, data)
+        return None
@@ -0,0 +1,104 @@
+import os
+import hashlib
+import threading
+
+RECORD_SIZE = 8
+
+
+def record_key(depot_path, offset=None):
+    if offset is None:
+        text = depot_path
+    else:
+        text = "{}:{}".format(depot_path, offset)
+    return hashlib.blake2b(
+        text.encode("utf-8"), digest_size=RECORD_SIZE).digest()
+
+
+class DownloadJournal:
+    """
+    Append-only record of the chunks and files of a manifest that have
+    been written and verified, so an interrupted download can skip them
+    when restarted. Every entry is an 8 byte hash of the depot path and,
+    for chunks, the offset inside the file.
+
+    Added records are buffered until commit, which first calls a sync
+    function to make the data they describe durable and then fsyncs the
+    journal, so a crash can't leave records for data that never reached
+    the disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.completed = set()
+        self.pending = []
+        if os.path.exists(path):
+            with open(path, "rb") as fobj:
+                data = fobj.read()
+            # A torn last record from an interrupted write is ignored
+            usable = len(data) - len(data) % RECORD_SIZE
+            for pos in range(0, usable, RECORD_SIZE):
+                self.completed.add(data[pos:pos + RECORD_SIZE])
+            if usable != len(data):
+                with open(path, "r+b") as fobj:
+                    fobj.truncate(usable)
+        self.fobj = open(path, "ab")
+
+    @classmethod
+    def for_manifest(cls, directory, manifest_id):
+        os.makedirs(directory, exist_ok=True)
+        return cls(os.path.join(directory, manifest_id + ".journal"))
+
+    def add(self, key):
+        with self.lock:
+            if key in self.completed:
+                return
+            self.completed.add(key)
+            self.pending.append(key)
+
+    def commit(self, sync=None):
+        """
+        Writes the records added so far to disk. sync is called before,
+        it has to make the data of those records durable, e.g. with
+        FileAssembler.sync.
+        """
+        with self.lock:
+            records = self.pending
+            self.pending = []
+        if not records:
+            return
+        if sync is not None:
+            sync()
+        with self.write_lock:
+            self.fobj.write(b"".join(records))
+            self.fobj.flush()
+            os.fsync(self.fobj.fileno())
+
+    def has_chunk(self, depot_path, offset):
+        return record_key(depot_path, offset) in self.completed
+
+    def add_chunk(self, depot_path, offset):
+        self.add(record_key(depot_path, offset))
+
+    def has_file(self, depot_path):
+        return record_key(depot_path) in self.completed
+
+    def add_file(self, depot_path):
+        self.add(record_key(depot_path))
+
+    def close(self):
+        """Commits the remaining records without syncing their data"""
+        self.commit()
+        self.fobj.close()
+
+    def discard(self):
+        """Closes and deletes the journal, e.g. after a finished install"""
+        self.close()
+        os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
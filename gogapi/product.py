@@ -6,8 +6,8 @@ import re
 
 import dateutil.parser
 
-from gogapi.contentsystem import Build, SecureLinkV2
-from gogapi.download import Download
+from gogapi.contentsystem import Build
+from gogapi.download import Download, update_files, LINK_WORKERS
 from gogapi.normalization import normalize_system, normalize_language
 from gogapi.base import GogObject, MissingResourceError, logger
 
@@ -326,17 +326,23 @@ class Product(GogObject):
         if system == "mac":
             system = "osx"
 
-        data = self.api.galaxy_builds(self.id, system)
-        builds_dirty = [Build(self.api, build_data) for build_data in data["items"]]
-        builds_dedup = {build.id: build for build in builds_dirty}
-        return list(builds_dedup.values())
+        # Builds are only parsed again when the listing changed
+        resp = self.api.galaxy_builds_cached(self.id, system)
+        if "builds" not in resp.parsed:
+            builds_dirty = [
+                Build(self.api, build_data)
+                for build_data in resp.data["items"]]
+            builds_dedup = {build.id: build for build in builds_dirty}
+            resp.parsed["builds"] = list(builds_dedup.values())
+        return list(resp.parsed["builds"])
 
     def get_secure_link(self, path, generation):
-        link_data = self.api.galaxy_secure_link(self.id, path, generation)
-        if generation == 1:
-            raise NotImplementedError("V1 not implemented")
-        elif generation == 2:
-            return SecureLinkV2(self.api, link_data)
+        """Returns a cached link while it is still valid"""
+        return self.api.secure_links.get(self.id, path, generation)
+
+    def get_secure_link_handle(self, path, generation):
+        """Returns a link handle that refreshes itself when expired"""
+        return self.api.secure_links.handle(self.id, path, generation)
 
     @property
     def required_product(self):
@@ -351,6 +357,16 @@ class Product(GogObject):
             self.installers, self.patches, self.language_packs,
             self.bonus_content)
 
+    def update_download_files(self, chunklists=True, max_workers=LINK_WORKERS):
+        """
+        Resolves infolinks and chunklists of all download files at once,
+        returns the files that failed
+        """
+        return update_files(
+            [fileobj for download in self.downloads
+                for fileobj in download.files],
+            chunklists, max_workers)
+
     @property
     def forum_slug(self):
         return self.link_forum.rsplit('/', 1)[1]
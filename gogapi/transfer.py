@@ -0,0 +1,158 @@
+import time
+import threading
+import itertools
+import urllib.parse
+
+from gogapi.base import GogError
+
+BLOCK_SIZE = 64 * 1024
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter. Consumers may overdraw the bucket and then
+    sleep until the debt has been refilled, so requests larger than the
+    burst size still work.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+class BandwidthScheduler:
+    """
+    Shares bandwidth and connections between download jobs in the same
+    process.
+
+    rate: Global limit in bytes per second, None for unlimited
+    host_rate: Limit per host in bytes per second, None for unlimited
+    max_connections: Concurrent requests shared by all jobs
+
+    Free connections go to the waiting job with the highest priority, and
+    between jobs of equal priority to the one with the fewest active
+    connections.
+    """
+
+    def __init__(self, rate=None, host_rate=None, max_connections=32):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.host_rate = host_rate
+        self.host_buckets = {}
+        self.free = max_connections
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.counter = itertools.count()
+
+    def job(self, priority=0):
+        return DownloadJob(self, priority)
+
+    def next_ticket(self):
+        return min(
+            self.waiting,
+            key=lambda ticket: (
+                -ticket[1].priority, ticket[1].active, ticket[0]))
+
+    def acquire(self, job):
+        with self.condition:
+            ticket = (next(self.counter), job)
+            self.waiting.append(ticket)
+            while self.free == 0 or self.next_ticket() is not ticket:
+                self.condition.wait()
+            self.waiting.remove(ticket)
+            self.free -= 1
+            job.active += 1
+            self.condition.notify_all()
+
+    def release(self, job):
+        with self.condition:
+            self.free += 1
+            job.active -= 1
+            self.condition.notify_all()
+
+    def throttle(self, host, amount):
+        if self.bucket is not None:
+            self.bucket.consume(amount)
+        if self.host_rate:
+            with self.condition:
+                bucket = self.host_buckets.get(host)
+                if bucket is None:
+                    bucket = TokenBucket(self.host_rate)
+                    self.host_buckets[host] = bucket
+            bucket.consume(amount)
+
+
+class DownloadJob:
+    """Handle through which a job's requests are scheduled"""
+
+    def __init__(self, scheduler, priority=0):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.active = 0
+
+    def iter_content(self, api, url, block_size=BLOCK_SIZE, **kwargs):
+        host = urllib.parse.urlsplit(url).netloc
+        self.scheduler.acquire(self)
+        try:
+            resp = api.get(url, stream=True, authorized=False, **kwargs)
+            try:
+                check_range(resp, kwargs)
+                for block in resp.iter_content(block_size):
+                    self.scheduler.throttle(host, len(block))
+                    yield block
+            finally:
+                resp.close()
+        finally:
+            self.scheduler.release(self)
+
+    def fetch(self, api, url, **kwargs):
+        return b"".join(self.iter_content(api, url, **kwargs))
+
+    def __repr__(self):
+        return "DownloadJob(priority={!r}, active={!r})".format(
+            self.priority, self.active)
+
+
+def iter_content(api, url, job=None, block_size=BLOCK_SIZE, **kwargs):
+    """Streams an unauthorized GET, scheduled through job if given"""
+    if job is not None:
+        yield from job.iter_content(api, url, block_size, **kwargs)
+        return
+    resp = api.get(url, stream=True, authorized=False, **kwargs)
+    try:
+        check_range(resp, kwargs)
+        yield from resp.iter_content(block_size)
+    finally:
+        resp.close()
+
+def fetch(api, url, job=None, **kwargs):
+    """Returns the body of an unauthorized GET, scheduled through job"""
+    if job is None:
+        resp = api.get(url, authorized=False, **kwargs)
+        check_range(resp, kwargs)
+        return resp.content
+    return job.fetch(api, url, **kwargs)
+
+def range_header(start, end):
+    """Range header for the bytes from start to end inclusive"""
+    return {"Range": "bytes={}-{}".format(start, end)}
+
+def check_range(resp, kwargs):
+    """Fails if the server ignored the Range header of a request"""
+    headers = kwargs.get("headers") or {}
+    if "Range" in headers and resp.status_code != 206:
+        raise GogError("Range request to {} returned status {}".format(
+            resp.url, resp.status_code))
@@ -8,6 +8,9 @@ setup(
         "requests",
         "python-dateutil"
     ],
+    extras_require={
+        "async": ["aiohttp"]
+    },
 
     author="Gabriel Huber",
     author_email="huberg18@gmail.com",